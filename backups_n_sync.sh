@@ -2,9 +2,36 @@
 VOLSLIST="/config/bns/backup_vols.txt"
 PRESCRIPT="/config/bns/backup_pre_script.sh"
 
-if [[ -f ${VOLSLIST} ]]
+if [ -z "${RCL_FLAGS}" ]; then
+	RCL_FLAGS="--transfers=8 --checkers=16 --fast-list --multi-thread-streams=4 --multi-thread-cutoff=100M"
+fi
+
+# live progress repaint is only useful on a real terminal ; in a docker
+# log pipe it just floods the log driver
+if [ -t 1 ]; then
+	RCL_PROGRESS="--progress"
+else
+	RCL_PROGRESS="--stats 30s --stats-one-line"
+fi
+
+if [ "${COMPRESSION}" = "zstd" ]; then
+	if [ -z "${ZSTD_LEVEL}" ]; then
+		ZSTD_LEVEL=3
+	fi
+	COMPRESS_PROG="zstd -T0 -${ZSTD_LEVEL}"
+	BKPEXT="tar.zst"
+else
+	COMPRESS_PROG="pigz --rsyncable"
+	BKPEXT="tar.gz"
+fi
+
+if [[ -f "${VOLSLIST}" ]]
 then
-	DATADIRS=$(cat ${VOLSLIST} |egrep -v "^#") 
+	DATADIRS=$(grep -Ev "^#|^[[:space:]]*$" "${VOLSLIST}")
+	if [ -z "${DATADIRS}" ]; then
+		echo "Volumes to Backup file is empty : ${VOLSLIST}"
+		exit
+	fi
 else
 	echo "Volumes to Backup file is missing : ${VOLSLIST}"
 	exit
@@ -24,11 +51,19 @@ else
 	export BKPDIR="${BKP_BASE_DIR}/${HOSTID}"
 fi
 
+# Remote destination is the same for the whole run, build it once
+RCL_DEST="${RCL_TARGET}:${RCL_PREFIX}/${HOSTID}/${RCL_SUFFIX}"
+
 if [ -z "${MAXBKP}" ]; then
 	export MAXBKP=7
 fi
 echo "Max backups to keep : ${MAXBKP}"
 
+if [ -z "${PARALLEL}" ]; then
+	export PARALLEL=1
+fi
+echo "Volumes backed up in parallel : ${PARALLEL}"
+
 echo "Base dir for volumes : ${SRC_VOL_BASE}"
 
 if [[ -f /config/rclone/rclone.conf ]]
@@ -40,46 +75,127 @@ else
 fi
 
 
+backup_volume () {
+	datadir=$1
+	echo "----------------------------------"
+	echo "Backing up '${SRC_VOL_BASE}/${datadir}'"
+
+	if [ "${FILE_SYNC}" = true ]; then
+		echo "File-sync backup of '${SRC_VOL_BASE}/${datadir}' to ${RCL_DEST}/${datadir}/current"
+		rclone ${RCL_FLAGS} sync "${SRC_VOL_BASE}/${datadir}" "${RCL_DEST}/${datadir}/current" --backup-dir "${RCL_DEST}/${datadir}/changed-${RUNTMSTP}"
+		return
+	fi
+	if [ "${STREAM_UPLOAD}" = true ]; then
+		echo "Streaming backup ${datadir}_${RUNTMSTP}.${BKPEXT} directly to ${RCL_DEST}/${datadir}"
+		tar -I "${COMPRESS_PROG}" -cpf - -C "${SRC_VOL_BASE}" "${datadir}" | rclone ${RCL_FLAGS} rcat "${RCL_DEST}/${datadir}/${datadir}_${RUNTMSTP}.${BKPEXT}"
+		return
+	fi
+	mkdir -p "${BKPDIR}/${datadir}" 2>&1 >/dev/null
+	if [ "${SKIP_UNCHANGED}" = true ]; then
+		last_bkp=$(ls "${BKPDIR}/${datadir}" |grep -E '\.tar\.(gz|zst)$' |sort -r |head -1)
+		if [ -n "${last_bkp}" ] && [ -z "$(find "${SRC_VOL_BASE}/${datadir}" -newer "${BKPDIR}/${datadir}/${last_bkp}" -print -quit)" ]; then
+			echo "Nothing changed in '${SRC_VOL_BASE}/${datadir}' since ${last_bkp} ... Skipping"
+			return
+		fi
+	fi
+	echo "Creating backup ${BKPDIR}/${datadir}/${datadir}_${RUNTMSTP}.${BKPEXT}"
+	if [ "${CHECKSUM}" = true ]; then
+		# tee lets the archive be written and hashed in a single pass
+		tar -I "${COMPRESS_PROG}" -cpf - -C "${SRC_VOL_BASE}" "${datadir}" \
+			| tee "${BKPDIR}/${datadir}/${datadir}_${RUNTMSTP}.${BKPEXT}" \
+			| sha256sum |cut -d' ' -f1 > "${BKPDIR}/${datadir}/${datadir}_${RUNTMSTP}.${BKPEXT}.sha256"
+	else
+		tar -I "${COMPRESS_PROG}" -cpf "${BKPDIR}/${datadir}/${datadir}_${RUNTMSTP}.${BKPEXT}" -C "${SRC_VOL_BASE}" "${datadir}"
+	fi
+
+	if [ "${TEST_ARCHIVE}" = true ]; then
+		# stream-decompress and list : validates the whole archive without extracting
+		if tar -I "${COMPRESS_PROG}" -tf "${BKPDIR}/${datadir}/${datadir}_${RUNTMSTP}.${BKPEXT}" >/dev/null; then
+			echo "Archive ${datadir}_${RUNTMSTP}.${BKPEXT} verified OK"
+		else
+			echo "Archive ${datadir}_${RUNTMSTP}.${BKPEXT} FAILED verification !"
+		fi
+	fi
+
+	echo "Cleaning old backups to keep only ${MAXBKP} files"
+	bkp_files=($(ls "${BKPDIR}/${datadir}" |grep -E '\.tar\.(gz|zst)$' |sort -r))
+	to_delete=()
+	for file in "${bkp_files[@]:0:${MAXBKP}}"; do
+		echo "+Keeping '${BKPDIR}/${datadir}/$file'"
+	done
+	for file in "${bkp_files[@]:${MAXBKP}}"; do
+		to_delete+=("${BKPDIR}/${datadir}/$file" "${BKPDIR}/${datadir}/$file.sha256")
+		echo "-Removing '${BKPDIR}/${datadir}/$file'"
+	done
+	if [ ${#to_delete[@]} -gt 0 ]; then
+		rm -f "${to_delete[@]}"
+	fi
+}
+
 # Main
 export RUNTMSTP=$(date +%Y%m%d)
 if [ -z "${SYNCONLY}" ]; then
 
-	if [[ -f ${PRESCRIPT} ]]
+	if [[ -f "${PRESCRIPT}" ]]
 	then
 		echo "Found Prescript ... running it"
-		${PRESCRIPT}
+		"${PRESCRIPT}"
 	fi
 
-	mkdir -p ${BKPDIR} 2>&1 >/dev/null
+	mkdir -p "${BKPDIR}" 2>&1 >/dev/null
 
-	for datadir in ${DATADIRS} 
+	# Check all volumes once up front so missing ones are reported
+	# before any backup starts
+	VALIDDIRS=""
+	NMISSING=0
+	for datadir in ${DATADIRS}
 	do
-		echo "----------------------------------"
-		
-		if [ -d ${SRC_VOL_BASE}/${datadir} ]; then
-			echo "Directory '${SRC_VOL_BASE}/${datadir}' exists"
-			mkdir -p ${BKPDIR}/${datadir} 2>&1 >/dev/null
-			echo "Creating backup ${BKPDIR}/${datadir}/${datadir}_${RUNTMSTP}.tar.gz"
-			tar czpf ${BKPDIR}/${datadir}/${datadir}_${RUNTMSTP}.tar.gz ${SRC_VOL_BASE}/${datadir}
-
-			echo "Cleaning old backups to keep only ${MAXBKP} files"
-			bkp_files=($(ls ${BKPDIR}/${datadir} |sort -r))
-			n=$MAXBKP
-			for file in "${bkp_files[@]}"; do
-				if [ "$n" -le 0 ]; then
-					rm "${BKPDIR}/${datadir}/$file"
-					echo "-Removing '${BKPDIR}/${datadir}/$file'"
-				else
-					echo "+Keeping '${BKPDIR}/${datadir}/$file'"
-					((n--))
-				fi
-			done
+		if [ -d "${SRC_VOL_BASE}/${datadir}" ]; then
+			VALIDDIRS="${VALIDDIRS} ${datadir}"
 		else
 			echo "Volume/dir '${SRC_VOL_BASE}/${datadir}' does not exists ... Skipping"
+			NMISSING=$((NMISSING + 1))
 		fi
 	done
+
+	for datadir in ${VALIDDIRS}
+	do
+		if [ "${PARALLEL}" -gt 1 ]; then
+			backup_volume "${datadir}" &
+			while [ $(jobs -rp |wc -l) -ge ${PARALLEL} ]; do
+				wait -n
+			done
+		else
+			backup_volume "${datadir}"
+		fi
+	done
+	wait
 fi
 echo "----------------------------------"
 echo "----------------------------------"
-echo "Syncing to ${RCL_TARGET} ${RCL_PREFIX}/${HOSTID}/${RCL_SUFFIX}"
-rclone -v --progress sync ${BKPDIR} ${RCL_TARGET}:${RCL_PREFIX}/${HOSTID}/${RCL_SUFFIX}
+if [ "${STREAM_UPLOAD}" = true ] || [ "${FILE_SYNC}" = true ]; then
+	echo "Backups were uploaded per volume, no local sync needed"
+else
+	if [ -z "${RCL_RETRIES}" ]; then
+		RCL_RETRIES=3
+	fi
+	echo "Syncing to ${RCL_DEST}"
+	try=0
+	until rclone -v ${RCL_PROGRESS} ${RCL_FLAGS} sync "${BKPDIR}" "${RCL_DEST}"; do
+		try=$((try + 1))
+		if [ ${try} -ge ${RCL_RETRIES} ]; then
+			echo "Sync failed after ${RCL_RETRIES} attempts ... giving up"
+			exit 1
+		fi
+		# exponential backoff with jitter so parallel hosts don't retry in lockstep
+		backoff=$(( (2 ** try) * 15 + RANDOM % 30 ))
+		echo "Sync failed ... retrying in ${backoff}s (attempt $((try + 1))/${RCL_RETRIES})"
+		sleep ${backoff}
+	done
+	if [ "${VERIFY}" = true ]; then
+		echo "Verifying remote copy of ${BKPDIR}"
+		rclone ${RCL_FLAGS} check "${BKPDIR}" "${RCL_DEST}"
+	fi
+fi
+echo "----------------------------------"
+echo "Run summary : $(echo ${VALIDDIRS} |wc -w) volume(s) processed, ${NMISSING:-0} missing, ${SECONDS}s elapsed"
@@ -1,5 +1,8 @@
 #!/bin/bash
 
+# exit as soon as docker asks us to stop, even mid-sleep
+trap 'echo "Stop signal received ... exiting"; exit 0' TERM INT
+
 LOOPIT=true
 if [ -z "${SKIPFIRSTRUN}" ]; then
     SKIPFIRSTRUN=true
@@ -32,9 +35,20 @@ while [ "$LOOPIT" = true ]; do
         # calculate duration of sleep
         current_time=$(date +%s)
         sleep_duration=$((target_time - current_time))
-        
-        # sleep until next wake-up time
+
+        # sleep until next wake-up time, in bounded slices re-checked against
+        # the absolute target so a paused container or clock step cannot
+        # oversleep past it
         echo "For now ... going to sleep for ${sleep_duration}s now until ${WAKEUPTIME}"
-        sleep $sleep_duration
+        while [ $(date +%s) -lt $target_time ]; do
+            remaining=$(($target_time - $(date +%s)))
+            if [ $remaining -gt 300 ]; then
+                sleep 300 &
+            else
+                sleep $remaining &
+            fi
+            # backgrounded sleep + wait so the TERM trap fires immediately
+            wait $!
+        done
     fi
 done
\ No newline at end of file